@@ -240,6 +240,25 @@ with open('bn_sed_model.pkl', 'wb') as f:
 print("Model saved successfully!")
 print("-" * 50)
 
+# --- 5.2 Export CPT Arrays for the Web API ---
+# The web API only needs the CPT arrays and state names, not the pgmpy
+# objects, so they are exported as plain NumPy/JSON files that can be
+# loaded without importing pgmpy. float32 is ample precision for these
+# illustrative probabilities and halves the size of every table.
+print("Exporting CPT arrays to 'bn_sed.npz' and 'bn_sed.json'...")
+import json
+import numpy as np
+
+np.savez('bn_sed.npz', **{cpd.variable: cpd.values.astype(np.float32) for cpd in model.get_cpds()})
+with open('bn_sed.json', 'w') as f:
+    json.dump({
+        # Axis order of each CPT array: the variable itself, then its parents
+        'cpds': {cpd.variable: list(cpd.variables) for cpd in model.get_cpds()},
+        'state_names': {cpd.variable: cpd.state_names[cpd.variable] for cpd in model.get_cpds()}
+    }, f, indent=2)
+print("CPT arrays exported successfully!")
+print("-" * 50)
+
 # --- 6. Perform Probabilistic Inference ---
 # Initialize the inference engine. VariableElimination is a common exact
 # inference algorithm. [36]
@@ -3,11 +3,17 @@ Bayesian Network Sediment Model API
 
 This Flask application serves a pre-trained Bayesian Network model for sediment prediction.
 It provides a RESTful API endpoint for making predictions.
+
+The model is loaded from the CPT arrays exported by BN_Sed_model.py, so the
+API only needs NumPy and does not import pgmpy.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 from flask_cors import CORS
-import pickle
+import orjson
+import itertools
+import os
+from functools import lru_cache
 import numpy as np
 
 # Initialize Flask application
@@ -16,36 +22,285 @@ app = Flask(__name__)
 # Enable CORS to allow requests from any origin
 CORS(app)
 
-# Global variable to store the loaded model
-model = None
+# CPT arrays exported by BN_Sed_model.py (next to this file unless MODEL_PATH
+# is set), with their metadata alongside
+MODEL_ARRAYS = os.environ.get(
+    'MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bn_sed.npz'))
+MODEL_METADATA = os.path.splitext(MODEL_ARRAYS)[0] + '.json'
+
+# Variable predicted by the /predict endpoint
+QUERY_VARIABLE = 'Ecological_Effect'
+
+# CPTs and posteriors are held in float32; these small tables need nothing wider
+DTYPE = np.float32
+
+# Smallest contraction step (product of its index sizes) worth handing to
+# np.tensordot; below it tensordot's Python overhead outweighs BLAS
+TENSORDOT_MIN_SIZE = 256
+
+# Decimal places reported for probabilities, matching float32 precision
+PROBABILITY_DECIMALS = 6
+
+# Evidence variables accepted by /predict, in the axis order of the posterior table
+EVIDENCE_VARIABLES = ['Contaminant_Conc', 'TOC', 'Grain_Size', 'Benthic_Community_Type']
+
+# TOC (%) at or above which organic carbon is treated as 'High'
+TOC_THRESHOLD = 1.0
+
+# Posterior table index of every state accepted by the API, per evidence
+# variable. Grain size classes are folded onto the model's Coarse/Fine
+# states, and None selects the trailing "unobserved" slot.
+STATE_INDEX = {
+    'Contaminant_Conc': {'Low': 0, 'Medium': 1, 'High': 2, None: 3},
+    'TOC': {'Low': 0, 'High': 1, None: 2},
+    'Grain_Size': {'Coarse': 0, 'Fine': 1, 'Sand': 0, 'Gravel': 0, 'Clay': 1, 'Silt': 1, None: 2},
+    'Benthic_Community_Type': {'Robust': 0, 'Sensitive': 1, None: 2}
+}
+
+# States of QUERY_VARIABLE, in the order of the posterior table's last axis
+EFFECT_STATES = ['None', 'Moderate', 'Severe']
+
+# State names of every variable, filled in when the model is loaded
+state_names = {}
+
+# (variables, values) of every CPT, extracted from the model once at load
+cpts = []
+
+# Posterior over QUERY_VARIABLE for every evidence combination
+posterior_table = None
+
+# Compiled inference programs, keyed by the set of observed variables
+_programs = {}
+
+def read_exported_model():
+    """Read the CPT arrays and state names exported by BN_Sed_model.py."""
+    with open(MODEL_METADATA, 'rb') as f:
+        metadata = orjson.loads(f.read())
+    with np.load(MODEL_ARRAYS) as arrays:
+        tables = [(variables, arrays[var]) for var, variables in metadata['cpds'].items()]
+    return tables, metadata['state_names']
 
 def load_model():
-    """Load the pre-trained Bayesian Network model."""
-    global model
+    """Load the CPT arrays and state names of the Bayesian Network model."""
+    global posterior_table
     try:
-        import dill
         print("Loading model...")
-        with open('/home/jasennelson/mysite/bn_sed_model.pkl', 'rb') as f:
-            model_data = dill.load(f)
-            model = model_data['model']
-            # Rebuild the model with CPDs
-            for cpd in model_data['cpds']:
-                model.add_cpds(cpd)
+        tables, names = read_exported_model()
+        cpts[:] = [(variables, np.asarray(values, dtype=DTYPE)) for variables, values in tables]
+        state_names.clear()
+        state_names.update(names)
+        check_state_index()
+        _programs.clear()
+        posterior_table = build_posterior_table()
+        _predict.cache_clear()
         print("Model loaded successfully!")
-    except FileNotFoundError:
-        print("Error: Model file 'bn_sed_model.pkl' not found.")
+    except FileNotFoundError as e:
+        print(f"Error: Model file '{e.filename}' not found.")
     except Exception as e:
         print(f"Error loading model: {str(e)}")
         import traceback
         traceback.print_exc()
 
+def check_state_index():
+    """Ensure STATE_INDEX and EFFECT_STATES match the states of the loaded model."""
+    for var in EVIDENCE_VARIABLES:
+        states = state_names[var]
+        lut = STATE_INDEX[var]
+        if [lut.get(state) for state in states] != list(range(len(states))) or lut[None] != len(states):
+            raise ValueError(f"STATE_INDEX does not match the {var} states {states}")
+    if state_names[QUERY_VARIABLE] != EFFECT_STATES:
+        raise ValueError(f"EFFECT_STATES does not match the {QUERY_VARIABLE} states")
+
+def prune_barren(variable, observed):
+    """
+    Return the CPTs that can affect a query on `variable`.
+
+    An unobserved leaf other than the query variable sums out to one, so
+    its CPT is dropped; this repeats until no such barren node is left
+    (e.g. Mortality_Growth and Community_Richness for Ecological_Effect).
+    """
+    tables = cpts
+    while True:
+        parents = {var for variables, _ in tables for var in variables[1:]}
+        kept = [(variables, values) for variables, values in tables
+                if variables[0] == variable or variables[0] in observed or variables[0] in parents]
+        if len(kept) == len(tables):
+            return kept
+        tables = kept
+
+def compile_query(variable, evidence_vars):
+    """
+    Compile a Variable Elimination query into a static schedule of einsum steps.
+
+    The structure and CPTs are fixed once the model is loaded, so the
+    elimination only depends on which variables are observed. Every CPT keeps
+    one axis per variable (child first, then parents, as stored by pgmpy),
+    transposed so its observed axes come first. At call time those axes are
+    gathered with arrays of state indices, giving every sliced CPT a shared
+    leading batch axis, and the remaining axes are contracted down to the
+    query variable by a precomputed schedule of pairwise einsum steps. A
+    whole batch of cases thus costs the same handful of calls as one case.
+
+    Returns:
+        A callable mapping {variable: array of state indices} to the
+        normalized posteriors over `variable`, one row per case (a single
+        row broadcasting to all cases if none of the evidence is relevant).
+    """
+    observed = frozenset(evidence_vars)
+    letters = {var: chr(ord('a') + i) for i, var in enumerate(state_names)}
+    batch = 'Z'
+
+    factors = []
+    for variables, values in prune_barren(variable, observed):
+        # Fully observed CPTs only scale each posterior and vanish on normalizing
+        if observed.issuperset(variables):
+            continue
+        gathered = [var for var in variables if var in observed]
+        free = [var for var in variables if var not in observed]
+        values = values.transpose([variables.index(var) for var in gathered + free])
+        subscripts = (batch if gathered else '') + ''.join(letters[var] for var in free)
+        factors.append((values, gathered, subscripts))
+    inputs = [f[2] for f in factors]
+    output = (batch if any(batch in subscripts for subscripts in inputs) else '') + letters[variable]
+
+    def operands(evidence):
+        return [values[tuple(evidence[var] for var in gathered)]
+                for values, gathered, _ in factors]
+
+    # The contraction order depends only on shapes, so any evidence will do;
+    # size the batch for every combination of the observed states
+    cases = int(np.prod([len(state_names[var]) for var in observed]))
+    sample = operands({var: np.zeros(cases, dtype=np.intp) for var in observed})
+    path, _ = np.einsum_path(','.join(inputs) + '->' + output, *sample, optimize='optimal')
+    sizes = {index: size for subscripts, operand in zip(inputs, sample)
+             for index, size in zip(subscripts, operand.shape)}
+    schedule = contraction_schedule(inputs, output, path[1:], sizes)
+
+    def program(evidence):
+        stack = operands(evidence)
+        for positions, step in schedule:
+            stack.append(step(*[stack.pop(i) for i in positions]))
+        posterior = stack[0]
+        return posterior / posterior.sum(axis=-1, keepdims=True)
+
+    return program
+
+def contraction_schedule(inputs, output, path, sizes):
+    """
+    Expand an einsum contraction path into explicit pairwise steps.
+
+    np.einsum re-parses the expression and rebuilds its contraction list on
+    every optimized call; running the frozen steps directly keeps that
+    structural work out of the query.
+
+    Returns:
+        A list of (operand positions, step function) pairs. The operands at
+        those positions are popped in order, passed to the step function and
+        the result is pushed on the end, following the np.einsum_path
+        convention.
+    """
+    inputs = list(inputs)
+    schedule = []
+    for step, contraction in enumerate(path):
+        positions = sorted(contraction, reverse=True)
+        picked = [inputs.pop(i) for i in positions]
+        if step == len(path) - 1:
+            result = output
+        else:
+            # Keep the indices still needed by another operand or the output
+            needed = set(''.join(inputs) + output)
+            result = ''.join(sorted(set(''.join(picked)) & needed))
+        schedule.append((positions, contraction_step(picked, result, sizes)))
+        inputs.append(result)
+    return schedule
+
+def contraction_step(inputs, output, sizes):
+    """
+    Return a function evaluating one contraction step.
+
+    A pair of factors whose shared indices are all summed out is a plain
+    tensor contraction, which np.tensordot hands to BLAS; the result axes
+    are then permuted into the expected order. Steps smaller than
+    TENSORDOT_MIN_SIZE, or that are not such a contraction (e.g. factors
+    sharing the batch axis), use einsum.
+    """
+    size = int(np.prod([sizes[index] for index in set(''.join(inputs))]))
+    if len(inputs) == 2 and size >= TENSORDOT_MIN_SIZE:
+        left, right = inputs
+        shared = [index for index in left if index in right]
+        if shared and not set(shared) & set(output) and set(left + right) - set(shared) <= set(output):
+            axes = ([left.index(index) for index in shared], [right.index(index) for index in shared])
+            produced = [index for index in left + right if index not in shared]
+            order = [produced.index(index) for index in output]
+            return lambda x, y: np.tensordot(x, y, axes=axes).transpose(order)
+    expression = ','.join(inputs) + '->' + output
+    return lambda *operands: np.einsum(expression, *operands, dtype=DTYPE)
+
+def get_program(evidence_vars):
+    """Return the compiled query program for a set of observed variables."""
+    key = frozenset(evidence_vars)
+    program = _programs.get(key)
+    if program is None:
+        program = _programs[key] = compile_query(QUERY_VARIABLE, key)
+    return program
+
+def build_posterior_table():
+    """
+    Precompute the posterior over QUERY_VARIABLE for every evidence combination.
+
+    The evidence space only has a few hundred cells, so the table is filled
+    once at load and /predict reduces to an array lookup. Each subset of
+    observed evidence variables is evaluated for all of its state
+    combinations in one batched program call. Every evidence axis has one
+    extra trailing slot holding the posterior with that variable left
+    unobserved.
+    """
+    cards = [len(state_names[var]) for var in EVIDENCE_VARIABLES]
+    query_card = len(state_names[QUERY_VARIABLE])
+    table = np.empty([card + 1 for card in cards] + [query_card], dtype=DTYPE)
+    for observed in itertools.product((True, False), repeat=len(EVIDENCE_VARIABLES)):
+        evidence_vars = [var for var, seen in zip(EVIDENCE_VARIABLES, observed) if seen]
+        shape = [len(state_names[var]) for var in evidence_vars]
+        combos = list(itertools.product(*(range(card) for card in shape)))
+        evidence = {var: np.array(column, dtype=np.intp)
+                    for var, column in zip(evidence_vars, zip(*combos))}
+        posterior = get_program(evidence_vars)(evidence)
+        cell = tuple(slice(card) if seen else card for seen, card in zip(observed, cards))
+        table[cell] = np.broadcast_to(posterior, (len(combos), query_card)).reshape(shape + [query_card])
+    return table
+
+def evidence_cell(data):
+    """Map a JSON payload to its cell of the posterior table."""
+    toc = data.get('toc', 1.0)
+    if toc not in STATE_INDEX['TOC']:
+        toc = 'High' if float(toc) >= TOC_THRESHOLD else 'Low'
+    states = (data.get('contaminant', 'Low'), toc, data.get('grain_size', 'Silt'), data.get('benthic'))
+    cell = []
+    for var, state in zip(EVIDENCE_VARIABLES, states):
+        index = STATE_INDEX[var].get(state)
+        if index is None:
+            raise ValueError(f"Unknown state {state!r} for {var}")
+        cell.append(index)
+    return tuple(cell)
+
+@lru_cache(maxsize=256)
+def _predict(contaminant, toc, grain_size, benthic):
+    """Return the most likely Ecological_Effect state and its probability for a table cell."""
+    posterior = posterior_table[contaminant, toc, grain_size, benthic]
+    index = int(np.argmax(posterior))
+    return EFFECT_STATES[index], round(float(posterior[index]), PROBABILITY_DECIMALS)
+
+def json_response(payload, status=200):
+    """Build a JSON response with orjson, which is much cheaper than jsonify."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 @app.route('/')
 def status():
     """Provide a simple status check."""
     # This lets you know the API is running without trying to serve a page.
-    return jsonify({
+    return json_response({
         'status': 'API is running',
-        'model_loaded': model is not None
+        'model_loaded': posterior_table is not None
     })
 @app.route('/predict', methods=['POST'])
 def predict():
@@ -55,63 +310,98 @@ def predict():
     Expected JSON payload format:
     {
         "contaminant": "Low/Medium/High",
-        "toc": float,
-        "grain_size": "Clay/Silt/Sand/Gravel"
+        "toc": float (%) or "Low/High",
+        "grain_size": "Clay/Silt/Sand/Gravel",
+        "benthic": "Robust/Sensitive" (optional)
     }
     
     Returns:
         JSON response with prediction and probability
     """
-    if model is None:
-        return jsonify({'error': 'Model is not loaded.'}), 500
+    if posterior_table is None:
+        return json_response({'error': 'Model is not loaded.'}, 500)
     
     try:
         # Get JSON data from request
-        data = request.get_json(force=True)
+        data = orjson.loads(request.get_data())
         
-        # Prepare evidence for prediction
-        evidence = {
-            'Contaminant_Level': data.get('contaminant', 'Low'),
-            'TOC_Content': data.get('toc', 1.0),
-            'Grain_Size': data.get('grain_size', 'Silt')
-        }
+        # Get the most likely Ecological_Effect state and its probability;
+        # the evidence space is small, so repeated queries hit the cache
+        prediction, probability = _predict(*evidence_cell(data))
         
-        # Make prediction using the model
-        from pgmpy.inference import VariableElimination
-        infer = VariableElimination(model)
+        # Return prediction
+        return json_response({
+            'status': 'success',
+            'prediction': prediction,
+            'probability': probability
+        })
         
-        # Get the probability distribution for Ecological_Effect
-        result = infer.query(variables=['Ecological_Effect'], evidence=evidence)
+    except Exception as e:
+        return json_response({
+            'status': 'error',
+            'message': str(e)
+        }, 400)
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """
+    Handle batched prediction requests.
+    
+    Expected JSON payload format:
+    {
+        "rows": [{same fields as /predict}, ...]
+    }
+    
+    Returns:
+        JSON response with a prediction and probability for every row
+    """
+    if posterior_table is None:
+        return json_response({'error': 'Model is not loaded.'}, 500)
+    
+    try:
+        # Get JSON data from request
+        data = orjson.loads(request.get_data())
+        rows = data.get('rows')
+        if not isinstance(rows, list):
+            raise ValueError("Expected a list of rows under 'rows'")
         
-        # Get the most likely state and its probability
-        prediction = max(result.values, key=lambda x: result.get_value(Ecological_Effect=x))
-        probability = result.get_value(Ecological_Effect=prediction)
+        # Build one column of table indices per evidence variable
+        cells = np.array([evidence_cell(row) for row in rows],
+                         dtype=np.intp).reshape(-1, len(EVIDENCE_VARIABLES))
         
-        # Return prediction
-        return jsonify({
+        # Gather every posterior with a single fancy index into the table
+        posteriors = posterior_table[tuple(cells.T)]
+        indices = posteriors.argmax(axis=1)
+        probabilities = posteriors[np.arange(len(indices)), indices].astype(float).round(PROBABILITY_DECIMALS)
+        
+        # Return predictions
+        return json_response({
             'status': 'success',
-            'prediction': prediction,
-            'probability': float(probability)
+            'predictions': [
+                {'prediction': EFFECT_STATES[index], 'probability': probability}
+                for index, probability in zip(indices.tolist(), probabilities.tolist())
+            ]
         })
         
     except Exception as e:
-        return jsonify({
+        return json_response({
             'status': 'error',
             'message': str(e)
-        }), 400
+        }, 400)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint to verify the API is running."""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
-        'model_loaded': model is not None
+        'model_loaded': posterior_table is not None
     })
 
-# Load the model when the application starts
+# Load the model when the application starts; under Gunicorn with
+# preload_app this runs once in the master process before forking
 load_model()
 
 if __name__ == '__main__':
-    # Run the Flask application
-    # In production, use a production WSGI server like Gunicorn
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Run the Flask development server for local testing only.
+    # In production, run `gunicorn app:app` (see gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,19 @@
+"""
+Gunicorn configuration for the Bayesian Network Sediment Model API.
+
+Usage:
+    gunicorn app:app
+"""
+
+import multiprocessing
+import os
+
+# Address to listen on
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# Number of worker processes
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# Import the app (and load the model) once in the master before forking,
+# so every worker shares the same copy-on-write model tables
+preload_app = True